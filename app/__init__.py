@@ -1,7 +1,12 @@
+"""
+Core of the app - the Flask app (config, database) and the Celery app
+
+Both the web process and the workers need this much, but nothing more is loaded here
+The web views are loaded by `app.web`, and the task modules by `app.worker`
+"""
 import os
 
 from flask import Flask
-from flask.templating import render_template
 
 from app.celery import make_celery
 
@@ -13,21 +18,15 @@ app.config.from_mapping(
     DATABASE=os.path.join(app.instance_path, "db", "resumable.sqlite"),
     # Path to folder for storing operation info
     OPERATIONS=os.path.join(app.instance_path, "operations"),
+    # Path to the dataset operations read from
+    # Its format is guessed from the path - see `app.sources.guess_format`
+    DATASET=os.path.join(app.instance_path, "MOCK_DATA.csv"),
 )
 app.config.from_object("app.config")
 
 celery = make_celery(app)
-celery.autodiscover_tasks(related_name="tappable")
-
-
-@app.route("/")
-def index():
-    return render_template("base.html")
 
 
 from app import db
 
 db.init_app(app)
-
-from app import auth
-from app import operations
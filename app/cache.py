@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+from flask import current_app
+
+from app.sources import Source
+
+# Maximum total size of the cached results, in bytes
+# Least recently used results are evicted once the cache grows past this
+CACHE_SIZE = 67108864
+
+
+def cache_dir():
+    # Directory the results are cached in
+    return os.path.join(current_app.config["OPERATIONS"], "cache")
+
+
+def cache_key(source: Source, pipeline: str):
+    """
+    Content address of the result of running given pipeline over given source
+
+    The source content is fingerprinted by its size and modification time (see
+    `Source.stamp`) rather than hashed, so computing the key doesn't read the source
+    """
+    definition = {
+        "source": source.spec(),
+        "stamp": source.stamp(),
+        "pipeline": pipeline,
+    }
+    return hashlib.sha256(
+        json.dumps(definition, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def cached_result(key: str) -> Optional[str]:
+    # Path of the cached result for given key (if any - `None` otherwise)
+    result_file = os.path.join(cache_dir(), f"{key}.json")
+    if not os.path.isfile(result_file):
+        return None
+    # Mark the result as recently used
+    os.utime(result_file)
+    return result_file
+
+
+def cache_result(key: str, result_file: str):
+    # Store the result file of an operation in the cache, under given key
+    os.makedirs(cache_dir(), exist_ok=True)
+    copy_file(result_file, os.path.join(cache_dir(), f"{key}.json"))
+    evict()
+
+
+def evict():
+    # Remove the least recently used results until the cache fits in `CACHE_SIZE`
+    entries = sorted(
+        (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+        for entry in os.scandir(cache_dir())
+        if entry.name.endswith(".json")
+    )
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= CACHE_SIZE:
+            break
+        os.remove(path)
+        total -= size
+
+
+def copy_file(src: str, dst: str):
+    # Copy a file atomically - readers never see a partial copy
+    tmpname = f"{dst}.{os.getpid()}.tmp"
+    shutil.copyfile(src, tmpname)
+    os.replace(tmpname, dst)
+
+
+def copy_result(result_file: str, operation_id: int):
+    # Give an operation its own copy of a result, returns the path of the copy
+    operation_dir = os.path.join(current_app.config["OPERATIONS"], f"{operation_id}")
+    os.makedirs(operation_dir, exist_ok=True)
+    copy = os.path.join(operation_dir, "result.json")
+    copy_file(result_file, copy)
+    return copy
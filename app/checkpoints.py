@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from sqlite3 import Connection, Row
+from typing import Any, List, Optional
+from uuid import uuid4
+
+from flask import current_app
+
+from app.utils import dump_json_atomic
+
+
+def checkpoint_files(operation_id: int, generation: int, token: str):
+    # Paths of the workflow and result files of given checkpoint generation
+    # `token` tells apart checkpoints racing for the same generation
+    operation_dir = os.path.join(current_app.config["OPERATIONS"], f"{operation_id}")
+    return (
+        os.path.join(operation_dir, f"workflow.{generation}.{token}.json"),
+        os.path.join(operation_dir, f"result.{generation}.{token}.json"),
+    )
+
+
+def write_checkpoint(
+    db: Connection,
+    operation_id: int,
+    retval: Any,
+    chains: List[dict],
+    expected: str,
+    completion: Optional[str] = None,
+):
+    """
+    Store the remaining workflow chain and the result (so far) of an operation as
+    a new checkpoint - and set the operation's `completion` to given status
+    (or leave it as is, if not given)
+
+    The checkpoint is only committed if the operation's status is still `expected` -
+    the status the caller decided to checkpoint in
+
+    A checkpoint is committed in 3 steps-
+    * Both files are written atomically (see `dump_json_atomic`) under new names, tagged
+      with the next checkpoint generation - so the previous checkpoint is left untouched
+    * The database row is pointed at the new files, and its generation is bumped - only
+      if it's still on the generation (and `expected` status) the files were written for. This
+      single update is the commit point - a crash before it leaves the previous
+      checkpoint in place
+    * Files of the previous generation are removed
+
+    A checkpoint that lost the race to bump the generation (e.g a redelivered task
+    checkpointing concurrently), or whose operation changed status meanwhile
+    (e.g pause requested during a periodic checkpoint) is discarded
+
+    Returns whether or not the checkpoint was committed
+    """
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    generation = operation["checkpoint_generation"] + 1
+    workflow_file, result_file = checkpoint_files(operation_id, generation, uuid4().hex)
+    os.makedirs(os.path.dirname(workflow_file), exist_ok=True)
+
+    # Both files carry the generation, so a resume can tell they belong together
+    dump_json_atomic({"generation": generation, "workflow": chains}, workflow_file)
+    dump_json_atomic({"generation": generation, "result": retval}, result_file)
+
+    committed = db.execute(
+        """
+        UPDATE operations
+        SET completion = ?,
+            workflow_store = ?,
+            result_store = ?,
+            checkpoint_generation = ?,
+            checkpoint_point = pause_point,
+            checkpointed_at = ?
+        WHERE id = ? AND checkpoint_generation = ? AND completion = ?
+        """,
+        (
+            completion or expected,
+            workflow_file,
+            result_file,
+            generation,
+            time.time(),
+            operation_id,
+            generation - 1,
+            expected,
+        ),
+    ).rowcount
+    db.commit()
+
+    # Remove the files that are no longer referenced by the database
+    stale = (
+        (operation["workflow_store"], operation["result_store"])
+        if committed
+        else (workflow_file, result_file)
+    )
+    for filename in stale:
+        if filename and os.path.isfile(filename):
+            os.remove(filename)
+    return bool(committed)
+
+
+def load_checkpoint(operation: Row):
+    """
+    Load the remaining workflow chain and the result (so far) of an operation's
+    latest checkpoint
+
+    Raises `ValueError` if the checkpoint files don't belong to the generation
+    recorded in the database - i.e the checkpoint is torn
+    """
+    generation = operation["checkpoint_generation"]
+    with open(operation["workflow_store"]) as f:
+        workflow = json.load(f)
+    with open(operation["result_store"], "r") as f:
+        result = json.load(f)
+    if workflow["generation"] != generation or result["generation"] != generation:
+        raise ValueError(
+            f"Checkpoint of operation {operation['id']} is not of generation {generation}"
+        )
+    return workflow["workflow"], result["result"]
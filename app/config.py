@@ -2,14 +2,14 @@
 
 # Make celery propagate exceptions instead of retrying
 CELERY_TASK_EAGER_PROPAGATES = True
-# Set expiry on task results (in seconds)
-CELERY_RESULT_EXPIRES = 5
-# Set the `backend_cleanup` task to run every 5 minutes
-CELERY_BEAT_SCHEDULE = {
-    "backend_cleanup": {
-        "task": "celery.backend_cleanup",
-        "schedule": 5.0 * 60.0,
-    },
-}
-# Route the backend_cleanup task to a separate queue
-CELERY_TASK_ROUTES = {"celery.backend_cleanup": {"queue": "periodic_cleanup"}}
+# Only reserve one task at a time per worker process, so long running operations
+# can't hoard messages from the other priority queues
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Acknowledge tasks after they're done, so tasks of a crashed worker are redelivered
+# A redelivered task may republish the rest of its chain - the duplicate chain is
+# dropped at its next pause point (see `app.tasks.record_progress`)
+CELERY_TASK_ACKS_LATE = True
+# Don't store task results, the results of tappable workflows are passed on
+# through the chain itself (and stored in checkpoints) - nothing reads them back
+# from the result backend
+CELERY_TASK_IGNORE_RESULT = True
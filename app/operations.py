@@ -1,23 +1,37 @@
-import os
 import json
+import time
+from sqlite3 import Connection, Row
+from typing import Any, Optional
 
 from flask import render_template, redirect
 from flask.globals import g
 from flask.helpers import url_for
 
-from app import app
+from app import app, celery
 from app.auth import login_required
+from app.cache import cache_key, cached_result, copy_result
 from app.db import get_db
-from app.tasks import (
-    read_finish_continue,
-    read_start,
-    read_next,
-    start_parsing,
-    should_pause,
-    save_state,
+from app.scheduling import (
+    preempt,
+    priority_for,
+    release_preempted,
+    request_pause,
+    resume_workflow,
+    route,
 )
+from app.sources import SOURCES, Source, guess_format
 from app.tappable import tappable
-from app.utils import deserialize_chain, b64encode_id, b64decode_id
+from app.utils import b64encode_id, b64decode_id
+
+
+def task_signature(name: str, *args):
+    """
+    Signature of a task from `app.tasks`, referred to by name
+
+    The web process only ever sends tasks off to the workers, so it doesn't import the
+    task modules (nor what they import) - see `app.worker`
+    """
+    return celery.signature(f"app.tasks.{name}", args=args)
 
 
 @app.route("/operations")
@@ -66,47 +80,263 @@ def operation_info(operation_id):
     )
 
 
-@app.route("/operations/start", methods=("POST",))
-@login_required
-def start():
-    # Start a csv reading + parsing operation
-    db = get_db()
+# Name of the pipeline operations run over the dataset - part of the result cache key
+PIPELINE = "count_ratio"
 
-    # Insert a record of the operation and grab its id
-    operation_id: int = db.execute(
-        "INSERT INTO operations (requester_id, completion) VALUES (?, ?)",
-        (g.user["id"], "IN PROGRESS"),
-    ).lastrowid
 
+def dataset_source():
+    # Source of the dataset operations read - only the columns the parsing needs
+    path = app.config["DATASET"]
+    return SOURCES[guess_format(path)](path, columns=["company", "gender"])
+
+
+def dispatch(
+    operation_id: int,
+    source: Source,
+    priority: int,
+    position: Optional[Any] = None,
+    base: Optional[dict] = None,
+):
     """
+    Start the workflow of an operation, reading from given source
+
+    To refresh the result of an earlier operation over the same (appended to) source,
+    pass the `position` it stopped reading at and its result as `base` - only the rows
+    from `position` onwards are then read and folded into `base`
+
     Brief description of the operation
     ----------------------------------
-    `read_start` initiates reading from the csv file
-    `read_next`, then continues reading from the same file and
+    `read_start` initiates reading from the dataset
+    `read_next`, then continues reading from the same dataset and
     merges its results with the previous read
-    `read_finish_continue`, determines whether or not the file has been
+    `read_finish_continue`, determines whether or not the dataset has been
     read in full and continues reading accordingly
 
     Once the iterative reading is finished, `start_parsing` is called
     to start the parsing operation
     """
-    csvpath = os.path.join(app.instance_path, "MOCK_DATA.csv")
     # Start the operation, using the usual tappable configuration
-    tappable(
-        # Chain of data reading + callback to data parsing
-        read_start.s(csvpath)
-        | read_next.s(csvpath)
-        | read_finish_continue.s(start_parsing.s(operation_id), csvpath, operation_id),
-        # Function to check whether or not operation should pause
-        should_pause.s(operation_id),
-        # Pause handler
-        save_state.s(operation_id),
+    # on the queue for its priority
+    route(
+        tappable(
+            # Chain of data reading + callback to data parsing
+            task_signature("read_start", source.spec(), position)
+            | task_signature("read_next", source.spec())
+            | task_signature(
+                "read_finish_continue",
+                route(task_signature("start_parsing", operation_id, base), priority),
+                source.spec(),
+                operation_id,
+            ),
+            # Function to check whether or not operation should pause
+            task_signature("should_pause", operation_id),
+            # Pause handler
+            task_signature("save_state", operation_id),
+            # Periodic checkpoint handler
+            checkpoint=task_signature("save_checkpoint", operation_id),
+            # Heartbeat
+            progress=task_signature("record_progress", operation_id),
+        ),
+        priority,
     ).delay()
 
+
+def restart(db: Connection, operation: Row):
+    """
+    Dispatch the workflow of an existing operation again, from the very beginning
+    For operations that have nothing to go on from - no checkpoint (or a torn one)
+
+    NOTE: The caller is responsible for committing
+    """
+    db.execute(
+        """
+        UPDATE operations
+        SET checkpointed_at = ?,
+            heartbeat_at = ?,
+            pause_point = ?
+        WHERE id = ?
+        """,
+        (time.time(), time.time(), 0, operation["id"]),
+    )
+    dispatch(operation["id"], dataset_source(), operation["priority"])
+
+
+def computing(db: Connection, key: str):
+    """
+    Get an operation that is computing the result for given cache key (if any - `None`
+    otherwise) - i.e one that is in progress, or that was only paused to make room for
+    another operation (it's resumed automatically, see `app.scheduling.preempt`)
+
+    Operations paused by their user (or cancelled) aren't computing anything
+    """
+    return db.execute(
+        """
+        SELECT * FROM operations
+        WHERE cache_key = ? AND (
+            completion = ?
+            OR (completion IN (?, ?) AND preempted_by IS NOT NULL)
+        )
+        """,
+        (key, "IN PROGRESS", "REQUESTING PAUSE", "PAUSED"),
+    ).fetchone()
+
+
+def hand_over(db: Connection, key: str):
+    """
+    Make sure the operations attached to given cache key are waiting on an operation
+    that is computing their result. If there's none anymore (e.g it was paused or
+    cancelled) the first attached operation takes over - it starts computing the result
+    itself, the others stay attached
+
+    Returns the id of the operation that took over (if any - `None` otherwise)
+    NOTE: The caller is responsible for committing
+    """
+    if key is None or computing(db, key) is not None:
+        return None
+    successor = db.execute(
+        """
+        SELECT * FROM operations
+        WHERE cache_key = ? AND completion = ?
+        ORDER BY id
+        """,
+        (key, "ATTACHED"),
+    ).fetchone()
+    if successor is None:
+        return None
+    db.execute(
+        "UPDATE operations SET completion = ? WHERE id = ?",
+        ("IN PROGRESS", successor["id"]),
+    )
+    restart(db, successor)
+    return successor["id"]
+
+
+def start_operation(
+    db: Connection,
+    user_id: int,
+    position: Optional[Any] = None,
+    base: Optional[dict] = None,
+):
+    """
+    Start a dataset reading + parsing operation for given user
+    See `dispatch` for `position` and `base`
+
+    Returns the id of the new operation
+    NOTE: The caller is responsible for committing
+    """
+    source = dataset_source()
+    # Schedule the operation based on its input size and the user's active operations
+    priority = priority_for(db, user_id, source.size())
+
+    # Identical operations (same pipeline over the same dataset content) share a result
+    key = cache_key(source, PIPELINE)
+    cached = cached_result(key)
+    # An identical operation that is currently running
+    leader = computing(db, key)
+    if cached is not None:
+        # Already computed - complete right away
+        completion = "COMPLETED"
+    elif leader is not None:
+        # Being computed - wait for the running operation to complete instead
+        completion = "ATTACHED"
+    else:
+        completion = "IN PROGRESS"
+
+    # Insert a record of the operation and grab its id
+    operation_id: int = db.execute(
+        """
+        INSERT INTO operations
+            (requester_id, completion, priority, checkpointed_at, heartbeat_at, cache_key)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (user_id, completion, priority, time.time(), time.time(), key),
+    ).lastrowid
+
+    if cached is not None:
+        # Take the position the result was computed up to from an identical operation
+        identical = db.execute(
+            """
+            SELECT source_position FROM operations
+            WHERE cache_key = ? AND source_position IS NOT NULL
+            """,
+            (key,),
+        ).fetchone()
+        db.execute(
+            """
+            UPDATE operations
+            SET result_store = ?,
+                source_position = ?
+            WHERE id = ?
+            """,
+            (
+                copy_result(cached, operation_id),
+                identical and identical["source_position"],
+                operation_id,
+            ),
+        )
+    elif leader is None:
+        # Make room for the operation by pausing lower priority ones
+        preempt(db, operation_id, priority)
+        dispatch(operation_id, source, priority, position, base)
+    return operation_id
+
+
+@app.route("/operations/start", methods=("POST",))
+@login_required
+def start():
+    # Start a dataset reading + parsing operation
+    db = get_db()
+
+    operation_id = start_operation(db, g.user["id"])
+
     db.commit()
     return redirect(url_for("operation_info", operation_id=b64encode_id(operation_id)))
 
 
+@app.route("/operations/refresh/<operation_id>", methods=("POST",))
+@login_required
+def refresh(operation_id):
+    """
+    Refresh the result of a completed operation, after the dataset was appended to
+
+    Starts a new operation that only reads the rows appended since the completed
+    operation stopped reading, and folds them into its result
+    """
+    operation_id = b64decode_id(operation_id)
+    db = get_db()
+
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+
+    if (
+        operation
+        and operation["completion"] == "COMPLETED"
+        and operation["source_position"] is not None
+    ):
+        with open(operation["result_store"], "r") as f:
+            base = json.load(f)
+        refreshed_id = start_operation(
+            db, g.user["id"], json.loads(operation["source_position"]), base
+        )
+        db.commit()
+        return redirect(
+            url_for("operation_info", operation_id=b64encode_id(refreshed_id))
+        )
+    elif not operation:
+        return {
+            "operation_id": b64encode_id(operation_id),
+            "success": False,
+            "message": "Invalid operation ID",
+        }
+    else:
+        return {
+            "operation_id": b64encode_id(operation_id),
+            "success": False,
+            "message": "Operation can not be refreshed",
+        }
+
+
 @app.route("/operations/pause/<operation_id>", methods=("POST",))
 @login_required
 def pause(operation_id):
@@ -124,14 +354,9 @@ def pause(operation_id):
         the `app.tappable.pause_or_continue` task is called - it'll know
         it should pause
         """
-        db.execute(
-            """
-            UPDATE operations
-            SET completion = ?
-            WHERE id = ?
-            """,
-            ("REQUESTING PAUSE", operation_id),
-        )
+        request_pause(db, operation_id)
+        # Operations attached to this one need another operation to compute the result
+        hand_over(db, operation["cache_key"])
         db.commit()
         return {"operation_id": b64encode_id(operation_id), "success": True}
     elif not operation:
@@ -160,25 +385,17 @@ def resume(operation_id):
     ).fetchone()
 
     if operation and operation["completion"] == "PAUSED":
-        # Load the remaining workflow and the result (so far)
-        with open(operation["workflow_store"]) as f:
-            workflow = json.load(f)
-        with open(operation["result_store"], "r") as f:
-            result = json.load(f)
-        # Initiate the remaining workflow and pass in the result
-        # NOTE: The workflow itself is already tappable so pausing after
-        # this point is also possible
-        deserialize_chain(workflow).delay(result)
-
-        db.execute(
-            """
-            UPDATE operations
-            SET completion = ?
-            WHERE id = ?
-            """,
-            ("IN PROGRESS", operation_id),
-        )
-        db.commit()
+        # Make room for the operation again, like it did when it started
+        preempt(db, operation_id, operation["priority"])
+        # Initiate the remaining workflow with the result (so far)
+        try:
+            resume_workflow(db, operation)
+        except ValueError:
+            return {
+                "operation_id": b64encode_id(operation_id),
+                "success": False,
+                "message": "Operation checkpoint is corrupted",
+            }
         return {"operation_id": b64encode_id(operation_id), "success": True}
     elif not operation:
         return {
@@ -197,7 +414,7 @@ def resume(operation_id):
 @app.route("/operations/cancel/<operation_id>", methods=("POST",))
 @login_required
 def cancel(operation_id):
-    # Cancel an operation altogether (only available after pausing)
+    # Cancel an operation altogether (only available after pausing, or while attached)
     operation_id = b64decode_id(operation_id)
     db = get_db()
 
@@ -205,7 +422,7 @@ def cancel(operation_id):
         "SELECT * FROM operations WHERE id = ?", (operation_id,)
     ).fetchone()
 
-    if operation and operation["completion"] == "PAUSED":
+    if operation and operation["completion"] in ("PAUSED", "ATTACHED"):
         db.execute(
             """
             UPDATE operations
@@ -214,6 +431,10 @@ def cancel(operation_id):
             """,
             ("CANCELLED", operation_id),
         )
+        # Operations preempted by this one can now continue
+        release_preempted(db, operation_id)
+        # Operations attached to this one need another operation to compute the result
+        hand_over(db, operation["cache_key"])
         db.commit()
         return {"operation_id": b64encode_id(operation_id), "success": True}
     elif not operation:
@@ -226,5 +447,5 @@ def cancel(operation_id):
         return {
             "operation_id": b64encode_id(operation_id),
             "success": False,
-            "message": "Operation is not paused",
+            "message": "Operation is neither paused nor attached",
         }
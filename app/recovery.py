@@ -0,0 +1,96 @@
+import time
+from sqlite3 import Connection
+
+import click
+from flask.app import Flask
+from flask.cli import with_appcontext
+
+from app.db import get_db
+from app.operations import hand_over, restart
+from app.scheduling import resume_workflow
+
+# Number of seconds without a heartbeat after which an operation is considered stalled
+# An operation beats at every pause point (see `app.tasks.record_progress`), so this
+# should be comfortably larger than the time between two pause points - including the
+# time their tasks may wait in a busy queue
+STALE_AFTER = 600
+
+
+def recover_stalled(db: Connection, stale_after: float):
+    """
+    Restart operations whose workers have died - i.e operations that are still
+    in progress, but haven't reached a pause point in the last `stale_after` seconds
+
+    Stalled operations are restarted from their latest checkpoint
+    Stalled operations that were requesting pause are simply marked as paused, at their
+    latest checkpoint - ready to be resumed by the user
+    Stalled operations that never checkpointed (or have a torn checkpoint) are restarted
+    from the very beginning - those that were requesting pause pause again at their
+    first pause point
+    Attached operations whose result is no longer being computed (e.g the operation they
+    were waiting on was paused) are handed over - see `app.operations.hand_over`
+
+    Returns a tuple of the ids of operations restarted from their checkpoint, and of
+    operations restarted from the beginning
+    """
+    stalled = db.execute(
+        """
+        SELECT * FROM operations
+        WHERE completion IN (?, ?) AND heartbeat_at < ?
+        """,
+        ("IN PROGRESS", "REQUESTING PAUSE", time.time() - stale_after),
+    ).fetchall()
+
+    recovered, restarted = [], []
+    for operation in stalled:
+        if operation["checkpoint_generation"] == 0:
+            restart(db, operation)
+            db.commit()
+            restarted.append(operation["id"])
+        elif operation["completion"] == "REQUESTING PAUSE":
+            db.execute(
+                "UPDATE operations SET completion = ? WHERE id = ?",
+                ("PAUSED", operation["id"]),
+            )
+            db.commit()
+            recovered.append(operation["id"])
+        else:
+            try:
+                resume_workflow(db, operation)
+            except ValueError:
+                restart(db, operation)
+                db.commit()
+                restarted.append(operation["id"])
+            else:
+                recovered.append(operation["id"])
+
+    attached = db.execute(
+        "SELECT DISTINCT cache_key FROM operations WHERE completion = ?", ("ATTACHED",)
+    ).fetchall()
+    for (key,) in attached:
+        successor = hand_over(db, key)
+        db.commit()
+        if successor is not None:
+            restarted.append(successor)
+    return recovered, restarted
+
+
+@click.command("recover-operations")
+@click.option(
+    "--stale-after",
+    default=STALE_AFTER,
+    show_default=True,
+    help="Seconds without a heartbeat after which an operation is stalled",
+)
+@with_appcontext
+def recover_operations_command(stale_after: float):
+    # Restart stalled operations from their latest checkpoint
+    recovered, restarted = recover_stalled(get_db(), stale_after)
+    click.echo(f"Recovered operations: {recovered}")
+    if restarted:
+        click.echo(f"Operations restarted from the beginning: {restarted}")
+
+
+def init_app(app: Flask):
+    # Register recovery functions with the Flask app
+    app.cli.add_command(recover_operations_command)
@@ -0,0 +1,183 @@
+import time
+from sqlite3 import Connection, Row
+from typing import Optional
+
+from celery.canvas import Signature, _chain
+
+from app.checkpoints import load_checkpoint
+from app.utils import deserialize_chain
+
+# Priorities an operation can be scheduled with - higher ones preempt lower ones
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+# Queue the tasks of an operation are routed to, for each priority
+PRIORITY_QUEUES = {
+    PRIORITY_LOW: "operations.low",
+    PRIORITY_NORMAL: "operations.normal",
+    PRIORITY_HIGH: "operations.high",
+}
+# Inputs smaller than this many bytes are small operations - scheduled as high priority
+SMALL_OPERATION_SIZE = 1048576
+# How many active operations a user may have before new ones are demoted to low priority
+FAIR_SHARE = 2
+# How many lower priority operations a single operation may preempt
+MAX_PREEMPTIONS = 1
+
+
+def priority_for(db: Connection, user_id: int, input_size: int):
+    """
+    Decide the priority a new operation of given user, over an input of given
+    size (in bytes), should be scheduled with
+
+    A user who already has `FAIR_SHARE` (or more) active operations gets low priority,
+    so they can't starve everyone else's operations
+    Otherwise, small operations get high priority - so they aren't stuck behind big ones -
+    and everything else gets normal priority
+    """
+    (active,) = db.execute(
+        """
+        SELECT COUNT(*) FROM operations
+        WHERE requester_id = ? AND completion IN (?, ?)
+        """,
+        (user_id, "IN PROGRESS", "REQUESTING PAUSE"),
+    ).fetchone()
+    if active >= FAIR_SHARE:
+        return PRIORITY_LOW
+    if input_size < SMALL_OPERATION_SIZE:
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+
+def route(sig: Signature, priority: int):
+    """
+    Route a task signature - or every task of a chain - to the queue for given priority
+
+    NOTE: Chains (`a | b` or `chain(a, b)`) are instances of `celery.canvas._chain`
+    An option set on the chain itself only applies to its first task, so the queue is
+    set on each task instead - including the `pause_or_continue` tasks of a tappable chain
+
+    The routing is stored in each task's options, so it survives serialization
+    i.e a paused workflow is resumed on the same queue
+
+    Returns the mutated signature
+    """
+    queue = PRIORITY_QUEUES[priority]
+    for task in sig.tasks if isinstance(sig, _chain) else (sig,):
+        task.set(queue=queue)
+    return sig
+
+
+def preempt(db: Connection, operation_id: int, priority: int):
+    """
+    Free up workers for the given operation by requesting lower priority operations
+    to pause - i.e the same "REQUESTING PAUSE" a user would make
+
+    At most `MAX_PREEMPTIONS` operations are preempted, lowest priority (and most
+    recently started) first. Preempted operations remember who preempted them, so they
+    can be resumed once the preempting operation stops running - i.e completes, pauses
+    or is cancelled - see `release_preempted`
+
+    NOTE: The caller is responsible for committing
+    """
+    victims = db.execute(
+        """
+        SELECT id FROM operations
+        WHERE completion = ? AND priority < ?
+        ORDER BY priority ASC, id DESC
+        LIMIT ?
+        """,
+        ("IN PROGRESS", priority, MAX_PREEMPTIONS),
+    ).fetchall()
+    for victim in victims:
+        request_pause(db, victim["id"], preempted_by=operation_id)
+
+
+def request_pause(
+    db: Connection, operation_id: int, preempted_by: Optional[int] = None
+):
+    """
+    Request an operation that's in progress to pause - it pauses at its next pause point
+    `preempted_by` is the operation the pause makes room for (if any)
+
+    An operation that stops running no longer needs the room it made by preempting
+    other operations, so those are continued right away - see `release_preempted`
+
+    NOTE: The caller is responsible for committing
+    """
+    db.execute(
+        """
+        UPDATE operations
+        SET completion = ?,
+            preempted_by = ?
+        WHERE id = ?
+        """,
+        ("REQUESTING PAUSE", preempted_by, operation_id),
+    )
+    release_preempted(db, operation_id)
+
+
+def release_preempted(db: Connection, operation_id: int):
+    """
+    Continue all operations preempted by given operation
+
+    Operations that have already paused are resumed, operations that haven't
+    reached a pause point yet simply have their pause request withdrawn
+    Operations with a torn checkpoint are left paused
+
+    NOTE: The caller is responsible for committing
+    """
+    preempted = db.execute(
+        "SELECT * FROM operations WHERE preempted_by = ?", (operation_id,)
+    ).fetchall()
+    for operation in preempted:
+        if operation["completion"] == "PAUSED":
+            try:
+                resume_workflow(db, operation)
+            except ValueError:
+                pass
+        else:
+            db.execute(
+                """
+                UPDATE operations
+                SET completion = ?,
+                    preempted_by = ?
+                WHERE id = ? AND completion = ?
+                """,
+                ("IN PROGRESS", None, operation["id"], "REQUESTING PAUSE"),
+            )
+
+
+def resume_workflow(db: Connection, operation: Row):
+    """
+    Resume a paused operation - i.e load its remaining workflow and the result (so far)
+    from its latest checkpoint and initiate the remaining workflow with the result
+
+    The operation is marked (and committed) as in progress *before* the workflow is
+    initiated, otherwise its first pause point could still see it as paused
+    Its progress is set back to the pause point the checkpoint was taken at, so the
+    pause points of the remaining workflow count as new (see `app.tasks.record_progress`)
+
+    Raises `ValueError` if the checkpoint is torn (see `load_checkpoint`)
+
+    NOTE: The workflow itself is already tappable so pausing after this point is also
+    possible. It's routed again, so every step is sent to the operation's queue - even
+    if the checkpoint lost (or never had) the routing of some steps
+    """
+    workflow, result = load_checkpoint(operation)
+    remaining = route(deserialize_chain(workflow), operation["priority"])
+
+    db.execute(
+        """
+        UPDATE operations
+        SET completion = ?,
+            preempted_by = ?,
+            pause_point = checkpoint_point,
+            checkpointed_at = ?,
+            heartbeat_at = ?
+        WHERE id = ?
+        """,
+        ("IN PROGRESS", None, time.time(), time.time(), operation["id"]),
+    )
+    db.commit()
+    remaining.delay(result)
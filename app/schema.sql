@@ -15,7 +15,23 @@ CREATE TABLE operations (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   requester_id INTEGER NOT NULL,
   completion TEXT NOT NULL,
+  priority INTEGER NOT NULL DEFAULT 1,
+  preempted_by INTEGER,
   workflow_store TEXT,
   result_store TEXT,
-  FOREIGN KEY (requester_id) REFERENCES user (id)
+  checkpoint_generation INTEGER NOT NULL DEFAULT 0,
+  -- Pause point the latest checkpoint was taken at
+  checkpoint_point INTEGER NOT NULL DEFAULT 0,
+  -- Unix time of the latest checkpoint (or the latest (re)start)
+  checkpointed_at REAL,
+  -- Unix time the operation last reached a pause point (or was (re)started)
+  heartbeat_at REAL,
+  -- Number of the latest pause point the operation reached, across all of its chains
+  pause_point INTEGER NOT NULL DEFAULT 0,
+  -- Content address of the result, shared by identical operations
+  cache_key TEXT,
+  -- Json encoded source position the operation stopped reading at
+  source_position TEXT,
+  FOREIGN KEY (requester_id) REFERENCES user (id),
+  FOREIGN KEY (preempted_by) REFERENCES operations (id)
 );
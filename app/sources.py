@@ -0,0 +1,330 @@
+import csv
+import gzip
+import json
+import os
+import warnings
+import zlib
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from io import StringIO
+from typing import Any, Dict, List, Optional
+
+from app.utils import dump_json_atomic, read_chunk, read_csv_rows
+
+# Gzip members that decompress to more than this many bytes are slow to resume within
+# Each read decompresses its member from the start, so reading such a member in full
+# takes time quadratic in its size - a warning is issued when one is found
+GZIP_MEMBER_SIZE = 16777216
+
+
+class Source(ABC):
+    """
+    A resumable source of rows - the base of all source adapters
+
+    A source is read in chunks, each read starts at a *position* and returns the
+    position to continue reading from. Positions are json serializable, so they can be
+    passed along a workflow chain (and stored in checkpoints) - i.e reading can be
+    resumed from any position, in any process
+
+    path: str
+        Path to the source file (or directory)
+
+    columns: List[str]
+        Columns the rows should contain, all columns if not given
+        Adapters only read the needed columns where the format allows it
+    """
+
+    # Name of the format, as used in a source spec
+    format = None
+
+    def __init__(self, path: str, columns: Optional[List[str]] = None):
+        self.path = path
+        self.columns = columns
+
+    def spec(self):
+        # Serialize the source into a json dict object - see `open_source`
+        return {"format": self.format, "path": self.path, "columns": self.columns}
+
+    def size(self):
+        # Size of the source on disk, in bytes
+        return os.path.getsize(self.path)
+
+    def stamp(self):
+        # Cheap fingerprint of the source content - changes whenever the content does
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @abstractmethod
+    def start(self):
+        """
+        Prepare reading the source from the beginning
+
+        Returns
+        ------
+        (fieldnames: List[str], position: Any)
+            A Tuple containing all the fieldnames of the source, and the position of
+            the first row
+        """
+
+    @abstractmethod
+    def read(self, fieldnames: List[str], position: Any, step: int, processes: int = 1):
+        """
+        Read roughly `step` bytes worth of rows, starting from given position
+        `fieldnames` are the fieldnames returned by `start`
+        `processes` may be used to parse the rows in parallel
+
+        Returns
+        ------
+        (next_position: Any, rows: List[Dict[str, Any]])
+            A Tuple containing the position to continue reading from, and the rows read
+            Once the source has reached its end, `next_position` is the same as given position
+        """
+
+    def project(self, row: Dict[str, Any]):
+        # Only keep the wanted columns of a row
+        if self.columns is None:
+            return row
+        return {name: row[name] for name in self.columns if name in row}
+
+
+class CsvSource(Source):
+    """
+    Newline delimited csv file, with a header row
+    Positions are byte offsets into the file
+    """
+
+    format = "csv"
+
+    def start(self):
+        with open(self.path, "rb") as f:
+            header = f.readline()
+        (fieldnames,) = csv.reader([header.decode("utf-8")])
+        return fieldnames, len(header)
+
+    def read(self, fieldnames: List[str], position: int, step: int, processes: int = 1):
+        return read_csv_rows(
+            self.path, position, step, fieldnames, processes, self.columns
+        )
+
+
+class GzipCsvSource(Source):
+    """
+    Gzip compressed, newline delimited csv file, with a header row
+    Positions are byte offsets into the *decompressed* content
+
+    The file is never decompressed to disk. Instead, an index of where each gzip member
+    starts (in both the compressed and decompressed content) is saved next to the file,
+    and reading starts decompressing from the member the position falls in
+
+    NOTE: Files written in many members - e.g compressed in blocks (`bgzip`) or appended
+    to by concatenating gzip files - resume in time proportional to the member size
+    A file written as a single member (e.g by plain `gzip`) has to be decompressed from
+    the start on each read - reading it in full takes quadratic time. A `RuntimeWarning`
+    is issued when the index finds a member larger than `GZIP_MEMBER_SIZE`, recompress
+    such files in blocks (e.g `bgzip`) instead
+    """
+
+    format = "csv.gz"
+
+    def index_path(self):
+        return f"{self.path}.idx.json"
+
+    def index(self):
+        """
+        Load the member index of the file - building (and saving) it if it doesn't exist
+        yet, or if the file changed since it was built
+
+        The index is a list of `[compressed_offset, decompressed_offset]` pairs, one for
+        each member, in order
+        """
+        stamp = self.stamp()
+        if os.path.isfile(self.index_path()):
+            with open(self.index_path()) as f:
+                saved = json.load(f)
+            if saved["stamp"] == stamp:
+                return saved["members"]
+
+        members = []
+        consumed, decompressed = 0, 0
+        decompressor = None
+        with open(self.path, "rb") as f:
+            data = f.read(65536)
+            while data:
+                if decompressor is None:
+                    # A new member starts at this compressed offset
+                    members.append([consumed, decompressed])
+                    decompressor = zlib.decompressobj(31)
+                decompressed += len(decompressor.decompress(data))
+                if decompressor.eof:
+                    # Member ended, whatever is left belongs to the next member
+                    consumed += len(data) - len(decompressor.unused_data)
+                    data = decompressor.unused_data or f.read(65536)
+                    decompressor = None
+                else:
+                    consumed += len(data)
+                    data = f.read(65536)
+
+        # Decompressed size of the largest member
+        ends = [member[1] for member in members[1:]] + [decompressed]
+        largest = max(
+            (end - member[1] for member, end in zip(members, ends)), default=0
+        )
+        if largest > GZIP_MEMBER_SIZE:
+            warnings.warn(
+                f"{self.path} has a gzip member of {largest} bytes (decompressed), "
+                "reading it takes time quadratic in that size - recompress it in "
+                "blocks (e.g with `bgzip`)",
+                RuntimeWarning,
+            )
+
+        dump_json_atomic({"stamp": stamp, "members": members}, self.index_path())
+        return members
+
+    def start(self):
+        with gzip.open(self.path, "rb") as f:
+            header = f.readline()
+        (fieldnames,) = csv.reader([header.decode("utf-8")])
+        return fieldnames, len(header)
+
+    def read(self, fieldnames: List[str], position: int, step: int, processes: int = 1):
+        members = self.index()
+        # The member the position falls in
+        compressed, decompressed = members[
+            bisect_right([member[1] for member in members], position) - 1
+        ]
+        with open(self.path, "rb") as f:
+            f.seek(compressed)
+            with gzip.GzipFile(fileobj=f, mode="rb") as gz:
+                # Decompress up to the position, within the member
+                gz.seek(position - decompressed)
+                content = gz.read(step)
+                while b"\n" not in content:
+                    # No newline yet - keep reading until the line ends (or EOF)
+                    more = gz.read(step)
+                    if not more:
+                        break
+                    content += more
+        # Trim off everything after the last newline - a last line without one isn't
+        # fully written yet (see `read_chunk`)
+        content = content[: content.rfind(b"\n") + 1]
+        rows = csv.DictReader(StringIO(content.decode("utf-8")), fieldnames=fieldnames)
+        return position + len(content), [self.project(row) for row in rows]
+
+
+class JsonLinesSource(Source):
+    """
+    JSON Lines file - one json object per line
+    Positions are byte offsets into the file
+    """
+
+    format = "jsonl"
+
+    def start(self):
+        with open(self.path, "rb") as f:
+            first = f.readline()
+        return list(json.loads(first)) if first.strip() else [], 0
+
+    def read(self, fieldnames: List[str], position: int, step: int, processes: int = 1):
+        (nxt, content) = read_chunk(self.path, position, step)
+        return nxt, [
+            self.project(json.loads(line)) for line in content.splitlines() if line
+        ]
+
+
+class ColumnarSource(Source):
+    """
+    A local columnar format - a directory with a `_schema.json` file listing the
+    fieldnames, and a `<fieldname>.col` file for each column, holding one json encoded
+    value per line (see `write_columnar`)
+
+    Only the files of the wanted columns are read
+    Positions are byte offsets into each of those column files
+    """
+
+    format = "columnar"
+
+    def column_path(self, name: str):
+        return os.path.join(self.path, f"{name}.col")
+
+    def size(self):
+        return sum(
+            os.path.getsize(os.path.join(self.path, name))
+            for name in os.listdir(self.path)
+        )
+
+    def stamp(self):
+        stamps = []
+        for name in sorted(os.listdir(self.path)):
+            stat = os.stat(os.path.join(self.path, name))
+            stamps.append([name, stat.st_size, stat.st_mtime_ns])
+        return stamps
+
+    def start(self):
+        with open(os.path.join(self.path, "_schema.json")) as f:
+            fieldnames = json.load(f)["fieldnames"]
+        return fieldnames, {name: 0 for name in self.columns or fieldnames}
+
+    def read(
+        self,
+        fieldnames: List[str],
+        position: Dict[str, int],
+        step: int,
+        processes: int = 1,
+    ):
+        names = list(position)
+        # The first column decides how many rows fit in the step
+        (_, content) = read_chunk(self.column_path(names[0]), position[names[0]], step)
+        columns = {names[0]: content.encode("utf-8").splitlines(keepends=True)}
+        amount = len(columns[names[0]])
+        for name in names[1:]:
+            # Read the same amount of rows from the other columns
+            with open(self.column_path(name), "rb") as f:
+                f.seek(position[name])
+                lines = [f.readline() for _ in range(amount)]
+            # Only up to the last fully written line (see `read_chunk`)
+            while lines and not lines[-1].endswith(b"\n"):
+                lines.pop()
+            columns[name] = lines
+            amount = min(amount, len(lines))
+        # Rows are only read up to where every column has been written
+        nxt_position = {
+            name: position[name] + sum(len(line) for line in columns[name][:amount])
+            for name in names
+        }
+        return nxt_position, [
+            {name: json.loads(columns[name][i]) for name in names}
+            for i in range(amount)
+        ]
+
+
+def write_columnar(path: str, fieldnames: List[str], rows: List[Dict[str, Any]]):
+    # Store rows in the columnar format read by `ColumnarSource`
+    os.makedirs(path, exist_ok=True)
+    for name in fieldnames:
+        with open(os.path.join(path, f"{name}.col"), "w") as f:
+            for row in rows:
+                f.write(json.dumps(row.get(name)) + "\n")
+    dump_json_atomic({"fieldnames": fieldnames}, os.path.join(path, "_schema.json"))
+
+
+# All source adapters, by format name
+SOURCES = {
+    source.format: source
+    for source in (CsvSource, GzipCsvSource, JsonLinesSource, ColumnarSource)
+}
+
+
+def guess_format(path: str):
+    # Guess the format of a source from its path
+    if os.path.isdir(path):
+        return ColumnarSource.format
+    if path.endswith(".gz"):
+        return GzipCsvSource.format
+    if path.endswith((".jsonl", ".ndjson")):
+        return JsonLinesSource.format
+    return CsvSource.format
+
+
+def open_source(spec: dict):
+    # Build a source from its spec (serialized json dict object) - see `Source.spec`
+    return SOURCES[spec["format"]](spec["path"], spec.get("columns"))
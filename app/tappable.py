@@ -6,21 +6,47 @@ from celery.canvas import Signature, chain, signature
 
 @shared_task(bind=True)
 def pause_or_continue(
-    self, retval: Optional[Any] = None, clause: dict = None, callback: dict = None
+    self,
+    retval: Optional[Any] = None,
+    clause: dict = None,
+    callback: dict = None,
+    checkpoint: dict = None,
+    checkpoint_now: bool = False,
+    progress: dict = None,
+    point: int = 0,
 ):
     # Task to use for deciding whether to pause the operation chain
+    if progress is not None and not signature(progress)(point):
+        # The operation already got past this pause point - this chain is a stale
+        # duplicate (e.g republished by a redelivered task), drop the remaining chain
+        self.request.chain = None
+        return "Skipping"
     if signature(clause)(retval):
         # Pause requested, call given callback with retval and remaining chain
         # chain should be reversed as the order of execution follows from end to start
-        signature(callback)(retval, self.request.chain[::-1])
-        self.request.chain = None
-        return "Pausing"
+        if signature(callback)(retval, self.request.chain[::-1]):
+            self.request.chain = None
+            return "Pausing"
+        # The pause didn't go through (e.g the operation was resumed meanwhile), go on
+        return retval
     else:
+        if checkpoint is not None and checkpoint_now:
+            # Save the state, without pausing, so a crash can resume from here
+            signature(checkpoint)(retval, self.request.chain[::-1])
         # Continue to the next task in chain
         return retval
 
 
-def tappable(ch: chain, clause: Signature, callback: Signature, nth: Optional[int] = 1):
+def tappable(
+    ch: chain,
+    clause: Signature,
+    callback: Signature,
+    nth: Optional[int] = 1,
+    checkpoint: Optional[Signature] = None,
+    checkpoint_every: Optional[int] = 1,
+    progress: Optional[Signature] = None,
+    first_point: Optional[int] = 0,
+):
     """
     Make a operation workflow chain pause-able/resume-able by inserting
     the pause_or_continue task for every nth task in given chain
@@ -39,10 +65,12 @@ def tappable(ch: chain, clause: Signature, callback: Signature, nth: Optional[in
         Signature of a task that takes 2 arguments - return value of
         last executed task in workflow (if any - othewise `None` is passsed) and
         remaining chain of the operation workflow as a json dict object
-        No return value is expected
+        - and returns a boolean, indicating whether or not the operation has paused
 
         This task will be called when `clause` returns `True` (i.e task is pausing)
         The return value and the remaining chain can be handled accordingly by this task
+        Should return False if the operation is no longer pausing (e.g the pause was
+        withdrawn after `clause` was checked) - the chain then continues normally
 
     nth: Int
         Check `clause` after every nth task in the chain
@@ -50,13 +78,56 @@ def tappable(ch: chain, clause: Signature, callback: Signature, nth: Optional[in
         Hence, by default, user given `clause` is called and checked
         after every task
 
+    checkpoint: Signature
+        Signature of a task that takes the same 2 arguments as `callback`
+        No return value is expected
+
+        If given, this task will be called at every `checkpoint_every`th pause point that
+        doesn't pause - to store the state *without* pausing, the chain keeps running
+        This way, an operation whose worker crashed can be restarted from its latest
+        checkpoint - rather than from the very beginning
+
+    checkpoint_every: Int
+        Call `checkpoint` at every nth pause point of the operation
+        Default value is 1, i.e call `checkpoint` at every pause point
+        (`checkpoint` itself can still throttle based on time)
+
+    progress: Signature
+        Signature of a task that takes one argument - the number of the pause point
+        that was reached (see `first_point`)
+        - and returns a boolean, indicating whether or not the chain should go on
+
+        If given, this task will be called at every pause point - before `clause` - so the
+        operation can keep track of how far it got, and when it last made progress
+        Should return False if the operation has already reached this pause point (or a
+        later one) - i.e the chain is a duplicate, e.g republished by a task that was
+        redelivered after its worker died. The chain then stops right there
+
+    first_point: Int
+        How many pause points of the operation precede the chain
+        Pause points are numbered on from there - so an operation that builds its workflow
+        out of several chains (e.g one per iteration) numbers its pause points across all
+        of them, rather than per chain
+        Default value is 0, i.e the chain is the start of the operation
+
     NOTE: The passed in chain is mutated in place
     Returns the mutated chain
     """
     newch = []
+    point = first_point
     for n, sig in enumerate(ch.tasks):
         if n != 0 and n % nth == nth - 1:
-            newch.append(pause_or_continue.s(clause=clause, callback=callback))
+            point += 1
+            newch.append(
+                pause_or_continue.s(
+                    clause=clause,
+                    callback=callback,
+                    checkpoint=checkpoint,
+                    checkpoint_now=point % checkpoint_every == 0,
+                    progress=progress,
+                    point=point,
+                )
+            )
         newch.append(sig)
     ch.tasks = tuple(newch)
     return ch
@@ -1,109 +1,150 @@
-import csv
-import os
 import json
-from io import StringIO
-from typing import Any, List, Dict, Tuple, Union
+import os
+import time
+from typing import Any, List, Dict, Optional, Tuple, Union
 
 from celery.canvas import chain, signature
 
 from app import app, celery
+from app.cache import cache_result, copy_result
+from app.checkpoints import write_checkpoint
 from app.db import get_db
+from app.scheduling import (
+    release_preempted,
+    route,
+)
+from app.sources import open_source
 from app.tappable import tappable
-from app.utils import chunks_of, read_chunk
+from app.utils import chunks_of, dump_json_atomic
 
-# How many bytes to read from file per task
+# How many bytes to read from a source per task (per process)
 READ_CHUNK_SIZE = 131072
+# How many processes to parse a chunk with, in a single reading task
+# Each task reads `READ_CHUNK_SIZE` bytes per process
+# NOTE: Parsing in parallel needs a `threads` or `solo` worker pool, and only the parsing
+# itself is parallel (see `app.utils.read_csv_rows`)
+READ_PROCESSES = 1
 # How many tasks to divide the csv parsing into (+-1)
 PARSE_CHUNK_AMOUNT = 100
+# Minimum number of seconds between periodic checkpoints of an operation
+CHECKPOINT_INTERVAL = 60
 
 
 @celery.task()
-def read_start(filename: str):
+def read_start(source: dict, position: Optional[Any] = None):
     """
-    First task in the iterative csv reading operation
+    First task in the iterative reading operation
 
-    Reads the first chunk from the given csv filename
-    Parses it into csv and extracts the fieldnames
-    Returns the fieldnames, next reading offset, and parsed csv
+    Opens the given source (serialized json dict object - see `app.sources.open_source`)
+    Extracts the fieldnames and reads the first chunk - from the beginning, or from given
+    position (e.g where an earlier operation over the same source stopped reading)
+    Returns the fieldnames, next reading position, and parsed rows
     as list of dicts - for the next task to process
     """
-    (nxt, csv_content) = read_chunk(filename, 0, READ_CHUNK_SIZE)
-    fst_csv = csv.DictReader(StringIO(csv_content))
-    return fst_csv.fieldnames, nxt, [dict(row) for row in fst_csv]
+    src = open_source(source)
+    fieldnames, first = src.start()
+    if position is None:
+        position = first
+    (nxt, rows) = src.read(fieldnames, position, READ_CHUNK_SIZE)
+    return fieldnames, nxt, rows
 
 
 @celery.task()
-def read_next(prevres: Tuple[List[str], int, List[Dict[str, str]]], filename: str):
+def read_next(prevres: Tuple[List[str], Any, List[Dict[str, str]]], source: dict):
     """
-    Continuation task in the iterative csv reading operation
+    Continuation task in the iterative reading operation
 
-    Expects fieldnames, reading offset and any previously parsed csv
+    Expects fieldnames, reading position and any previously parsed
     data to be passed as its first argument
 
-    Reads a chunk starting from given offset, parses it and passes next offset
-    and new list of dicts (from previous + current csv read) results to the next task
+    Reads a chunk starting from given position, parses it and passes next position
+    and new list of dicts (from previous + current read) results to the next task
     (along with the fieldnames from previous task)
 
-    If the read from file yielded an empty string (EOF reached), returns **only**
-    the final list of dicts (from previous + current csv read)
+    The chunk is parsed by `READ_PROCESSES` processes, if the source supports it
+    (see `app.utils.read_csv_rows`)
+
+    If the read from the source yielded nothing (end reached), returns **only**
+    the final position and the final list of dicts (from previous + current read)
     """
-    fieldnames, offset, accum = prevres
-    (nxt, csv_content) = read_chunk(filename, offset, READ_CHUNK_SIZE)
-    if csv_content == "":
-        return (accum,)
-    data = [
-        dict(row)
-        for row in csv.DictReader(StringIO(csv_content), fieldnames=fieldnames)
-    ]
+    fieldnames, position, accum = prevres
+    (nxt, data) = open_source(source).read(
+        fieldnames, position, READ_CHUNK_SIZE * READ_PROCESSES, READ_PROCESSES
+    )
+    if nxt == position:
+        return position, accum
     return fieldnames, nxt, accum + data
 
 
 @celery.task()
 def read_finish_continue(
     prevres: Union[
-        Tuple[List[str], int, List[Dict[str, str]]], Tuple[List[Dict[str, str]]]
+        Tuple[List[str], Any, List[Dict[str, str]]], Tuple[Any, List[Dict[str, str]]]
     ],
     callback: dict,
-    filename: str,
+    source: dict,
     operation_id: int,
 ):
     """
     NOTE: This task should be placed after each `read_next` task
     Checks whether the previous task (`read_next`) returned a tuple of 3
-    results or 1
+    results or 2
 
     If previous task returned a tuple of 3 results, it means EOF has not been reached
     and the operation should continue with another `read_next`
 
-    If previous task returned a tuple of 1 result (just the final list of dicts), EOF has been reached
-    - initiate the given callback (should be a serialized signature)
+    If previous task returned a tuple of 2 results (the final position and list of dicts), EOF
+    has been reached - record the final position (so a later operation can continue reading
+    from there) and initiate the given callback (should be a serialized signature)
     """
+    db = get_db()
     if len(prevres) == 3:
+        operation = db.execute(
+            "SELECT * FROM operations WHERE id = ?", (operation_id,)
+        ).fetchone()
         # Continue with another `read_next`, `read_finish_continue` pair
-        # Use the regular tappable configuration as well
-        tappable(
-            (
-                read_next.s(filename)
-                # Pass in the same callback, filename, and operation_id
-                | read_finish_continue.s(callback, filename, operation_id)
+        # Use the regular tappable configuration as well, on the operation's queue
+        route(
+            tappable(
+                (
+                    read_next.s(source)
+                    # Pass in the same callback, source, and operation_id
+                    | read_finish_continue.s(callback, source, operation_id)
+                ),
+                # Function to check whether or not operation should pause
+                should_pause.s(operation_id),
+                # Pause handler
+                save_state.s(operation_id),
+                # Periodic checkpoint handler
+                checkpoint=save_checkpoint.s(operation_id),
+                # Heartbeat, numbering pause points on from the ones already reached
+                progress=record_progress.s(operation_id),
+                first_point=operation["pause_point"],
             ),
-            # Function to check whether or not operation should pause
-            should_pause.s(operation_id),
-            # Pause handler
-            save_state.s(operation_id),
+            operation["priority"],
             # Start the chain with the previous result (tuple of 3 elements: see `read_next`)
         ).delay(prevres)
         # Just a dummy return to aid in logging - doesn't really serve a purpose
         return f"Continuing - Total rows read: {len(prevres[-1])}"
     else:
+        position, rows = prevres
+        db.execute(
+            "UPDATE operations SET source_position = ? WHERE id = ?",
+            (json.dumps(position), operation_id),
+        )
+        db.commit()
         # EOF reached, finished reading - initiate the callback task and pass it the final list of dicts
-        signature(callback).delay(prevres[0])
+        signature(callback).delay(rows)
         # Just a dummy return to aid in logging - doesn't really serve a purpose
         return f"Finished Reading - Total rows read: {len(prevres[-1])}"
 
 
 @celery.task()
-def start_parsing(retval: List[Dict[str, str]], operation_id: int):
+def start_parsing(
+    retval: List[Dict[str, str]],
+    operation_id: int,
+    base: Optional[Dict[str, Dict[str, int]]] = None,
+):
     """
     First task in the iterative parsing operation
     The parsing operation just counts the number of male and female employees
@@ -119,6 +160,10 @@ def start_parsing(retval: List[Dict[str, str]], operation_id: int):
     The `completion` task is chained at the end
     Ofcourse, the whole operation follows the regular tappable configuration
 
+    If given, the counts from `base` (the result of an earlier operation over the start
+    of the same dataset) are the starting values instead - so only the new rows are
+    folded into them
+
     NOTE: This operation depends on the previous chunk's results
     hence it's not suitable for `celery.chunks` - which is why a *chain*
     of manual chunks is used instead
@@ -129,18 +174,33 @@ def start_parsing(retval: List[Dict[str, str]], operation_id: int):
     """
     parse_chunks = chunks_of(retval, PARSE_CHUNK_AMOUNT)
     starting_accum = {entry["company"]: {"Male": 0, "Female": 0} for entry in retval}
-    tappable(
-        # A `fold` of `parse_chunks` over `count_ratio` tasks with a final callback `completion`
-        chain(
-            *[count_ratio.s(parse_chunk) for parse_chunk in parse_chunks],
-            completion.s(operation_id),
+    if base is not None:
+        starting_accum.update(base)
+    db = get_db()
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    route(
+        tappable(
+            # A `fold` of `parse_chunks` over `count_ratio` tasks with a final callback `completion`
+            chain(
+                *[count_ratio.s(parse_chunk) for parse_chunk in parse_chunks],
+                completion.s(operation_id),
+            ),
+            # Function to check whether or not operation should pause
+            should_pause.s(operation_id),
+            # Pause handler
+            save_state.s(operation_id),
+            # Periodic checkpoint handler
+            checkpoint=save_checkpoint.s(operation_id),
+            # Heartbeat, numbering pause points on from the ones already reached
+            progress=record_progress.s(operation_id),
+            first_point=operation["pause_point"],
+            # Insert the `pause_or_continue` task after every 2nd task
+            nth=2,
         ),
-        # Function to check whether or not operation should pause
-        should_pause.s(operation_id),
-        # Pause handler
-        save_state.s(operation_id),
-        # Insert the `pause_or_continue` task after every 2nd task
-        nth=2,
+        # Keep the operation on its queue
+        operation["priority"],
         # Pass the starting value for the `fold` operation
     ).delay(starting_accum)
 
@@ -175,8 +235,13 @@ def completion(retval: dict, operation_id: int):
         os.makedirs(operation_dir, exist_ok=True)
 
     # Store the result into a file
-    with open(result_file, "w") as f:
-        json.dump(retval, f)
+    dump_json_atomic(retval, result_file)
+
+    # Checkpoint files from earlier pauses (if any) are no longer needed
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    stale = (operation["workflow_store"], operation["result_store"])
 
     # Store result metadata into the database
     db.execute(
@@ -189,8 +254,38 @@ def completion(retval: dict, operation_id: int):
         """,
         ("COMPLETED", None, result_file, operation_id),
     )
+    if operation["cache_key"] is not None:
+        # Identical operations can reuse the result from now on
+        cache_result(operation["cache_key"], result_file)
+        # Complete the identical operations that were waiting on this one
+        attached = db.execute(
+            "SELECT id FROM operations WHERE cache_key = ? AND completion = ?",
+            (operation["cache_key"], "ATTACHED"),
+        ).fetchall()
+        for waiter in attached:
+            db.execute(
+                """
+                UPDATE operations
+                SET completion = ?,
+                    result_store = ?,
+                    source_position = ?
+                WHERE id = ?
+                """,
+                (
+                    "COMPLETED",
+                    copy_result(result_file, waiter["id"]),
+                    operation["source_position"],
+                    waiter["id"],
+                ),
+            )
+    # Operations preempted by this one can now continue
+    release_preempted(db, operation_id)
     db.commit()
 
+    for filename in stale:
+        if filename and filename != result_file and os.path.isfile(filename):
+            os.remove(filename)
+
 
 @celery.task()
 def should_pause(_, operation_id: int):
@@ -199,42 +294,78 @@ def should_pause(_, operation_id: int):
     db = get_db()
 
     # Check the database to see if user has requested pause on the operation
+    # An operation that is already paused should also stay paused - this can only be
+    # reached by a redelivered task, the remaining workflow is already saved
     operation = db.execute(
         "SELECT * FROM operations WHERE id = ?", (operation_id,)
     ).fetchone()
-    return operation["completion"] == "REQUESTING PAUSE"
+    return operation["completion"] in ("REQUESTING PAUSE", "PAUSED")
+
+
+@celery.task()
+def record_progress(point: int, operation_id: int):
+    # This is the `progress` to be used for `tappable`
+    # i.e this is called at every pause point - the heartbeat of the operation
+    db = get_db()
+
+    # Only move forward - a pause point the operation already got past belongs to a
+    # duplicate chain, as does any pause point of an operation that's no longer running
+    advanced = db.execute(
+        """
+        UPDATE operations
+        SET pause_point = ?,
+            heartbeat_at = ?
+        WHERE id = ? AND pause_point < ? AND completion IN (?, ?)
+        """,
+        (point, time.time(), operation_id, point, "IN PROGRESS", "REQUESTING PAUSE"),
+    ).rowcount
+    db.commit()
+    return bool(advanced)
 
 
 @celery.task()
 def save_state(retval: Any, chains: List[dict], operation_id: int):
     # This is the `callback` to be used for `tappable`
     # i.e this is called when an operation is pausing
+    # Returns whether or not the operation has paused
     db = get_db()
 
-    # Prepare directories to store the workflow
-    operation_dir = os.path.join(app.config["OPERATIONS"], f"{operation_id}")
-    workflow_file = os.path.join(operation_dir, "workflow.json")
-    result_file = os.path.join(operation_dir, "result.json")
-    if not os.path.isdir(operation_dir):
-        os.makedirs(operation_dir, exist_ok=True)
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    if operation["completion"] == "PAUSED":
+        # Already paused - this is a redelivered pause point, the state is saved already
+        return True
+
+    # Store the remaining workflow chain and the result (so far) as a checkpoint
+    # Only if the pause is still requested - it may have been withdrawn meanwhile (e.g a
+    # preempted operation released by `release_preempted`)
+    if write_checkpoint(db, operation_id, retval, chains, "REQUESTING PAUSE", "PAUSED"):
+        return True
+    operation = db.execute(
+        "SELECT completion FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    # Back in progress - keep going. Otherwise, the operation was paused concurrently
+    # (e.g by a redelivered pause point)
+    return operation["completion"] != "IN PROGRESS"
 
-    # Store the remaining workflow chain, serialized into json
-    with open(workflow_file, "w") as f:
-        json.dump(chains, f)
 
-    # Also store the result (so far) into a file
-    with open(result_file, "w") as f:
-        json.dump(retval, f)
+@celery.task()
+def save_checkpoint(retval: Any, chains: List[dict], operation_id: int):
+    # This is the `checkpoint` to be used for `tappable`
+    # i.e this is called periodically while an operation keeps running
+    db = get_db()
 
-    # Store the result from the last task and the workflow json path
-    db.execute(
-        """
-        UPDATE operations
-        SET completion = ?,
-            workflow_store = ?,
-            result_store = ?
-        WHERE id = ?
-        """,
-        ("PAUSED", workflow_file, result_file, operation_id),
-    )
-    db.commit()
+    operation = db.execute(
+        "SELECT * FROM operations WHERE id = ?", (operation_id,)
+    ).fetchone()
+    if (
+        operation["completion"] != "IN PROGRESS"
+        or time.time() - operation["checkpointed_at"] < CHECKPOINT_INTERVAL
+    ):
+        # Pausing (the pause saves the state anyway), or checkpointed recently enough
+        return
+
+    # Store the remaining workflow chain and the result (so far) as a checkpoint
+    # The operation stays in progress
+    write_checkpoint(db, operation_id, retval, chains, "IN PROGRESS")
@@ -1,5 +1,13 @@
+import csv
+import json
+import mmap
+import multiprocessing
+import os
+import threading
 from base64 import b64encode, b64decode
-from typing import Any, List
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from typing import Any, List, Optional
 
 from celery.canvas import signature, chain
 
@@ -46,35 +54,156 @@ def read_chunk(filename: str, offset: int, step: int, delimiter: str = "\n"):
 
     When the file has reached EOF, `read_chunk` will return an empty string as the second element of
     the tuple
+
+    A chunk always ends at a `delimiter` - the file may be an append-only log, so a last line
+    without a trailing `delimiter` is treated as not fully written yet, and isn't read until it
+    is. A line longer than `step` is read in full
     """
     with open(filename, "rb") as f:
         # Seek to the given offset (starting from beginning - i.e 0)
         f.seek(offset, 0)
         # Read step number of bytes from file
         content = f.read(step)
-    if content == "":
-        # Reached EOF - return same offset and empty content
-        return (offset, "")
-    # Try finding the `delimiter` byte closest to the end
-    for i, b in enumerate(reversed(content)):
-        if b == ord(delimiter):
-            break
-    else:
-        # No `delimiter` found - possibly the first line of file
-        i = 0
-    content_len = len(content)
+        while delimiter.encode() not in content:
+            # No `delimiter` found - keep reading until the line ends (or EOF is reached)
+            more = f.read(step)
+            if not more:
+                break
+            content += more
     """
     The position to "break" at (i.e start reading from on next call)
-    should be (given offset + number of bytes read) - (offset of `delimiter` byte from
-    the end of the read content)
+    should be right after the `delimiter` byte closest to the end of the read content
+    Everything after it is trimmed off - it's either part of the next read, or part of a line
+    that isn't fully written yet. With no `delimiter` at all, nothing is read - i.e EOF
+    """
+    content = content[: content.rfind(delimiter.encode()) + 1]
+    # Return the new breakpos to continue reading from, and the read content
+    return (offset + len(content), content.decode("utf-8"))
+
+
+# Process pool for parsing csv in parallel - created on first use, per worker process
+# Its processes are started by a forkserver, forking a worker with running threads
+# (e.g the `threads` pool) could copy locks held by those threads into the pool processes
+_parse_executor: Optional[ProcessPoolExecutor] = None
+_parse_executor_lock = threading.Lock()
+
+
+def _parse_csv_range(filename: str, start: int, end: int):
+    # Parse the csv rows in given byte range of a file into lists of values
+    # Lists (rather than dicts) are much cheaper to send back from the pool
+    with open(filename, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            content = mm[start:end].decode("utf-8")
+    return [row for row in csv.reader(StringIO(content)) if row]
+
+
+def read_csv_rows(
+    filename: str,
+    offset: int,
+    step: int,
+    fieldnames: List[str],
+    processes: int = 1,
+    columns: Optional[List[str]] = None,
+):
+    """
+    Read and parse the csv rows from a chunk of given file - the chunk starts at given
+    offset and is at most `step` bytes long, ending at the latest newline (like `read_chunk`,
+    a last line without a newline isn't read)
+
+    If `columns` is given, rows only contain those columns (otherwise, all of `fieldnames`)
+
+    With more than one process, the chunk is split into sub-ranges on newline boundaries
+    and each sub-range is parsed in a process pool - the pool processes map the file
+    themselves, only byte ranges are sent to them and only lists of values are sent back
+
+    NOTE: A process can only have a pool if it's not daemonic - celery's prefork pool
+    processes are daemonic. In that case (or with a single process) the chunk is parsed
+    in the current process instead. Use the `threads` or `solo` worker pool to parse
+    in parallel
+
+    Only the csv parsing itself is parallel - building the row dicts is not, and neither
+    is passing the rows along the chain. The latter re-serializes all of the rows read
+    so far on every read, and takes far longer than parsing once many rows are read
+    (parsing a 128KiB chunk took ~7ms, a json round trip of 300K rows ~700ms). So more
+    processes aren't expected to make an operation faster overall
+
+    Returns
+    ------
+    (next_offset: int, rows: List[Dict[str, str]])
+        A Tuple containing the next offset to continue reading from, and the parsed rows
+        Once the file has reached EOF, `next_offset` is the same as given offset
     """
-    breakpos = offset + content_len - i
+    global _parse_executor
+
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size:
+            # Reached EOF - return same offset and no rows
+            return (offset, [])
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = min(offset + step, size)
+            # Break after the latest newline - a last line without one isn't fully
+            # written yet (the file may be an append-only log), it's read once it is
+            breakpos = mm.rfind(b"\n", offset, end)
+            if breakpos == -1:
+                # No newline in the chunk - read the line in full, if it has ended
+                breakpos = mm.find(b"\n", end)
+            if breakpos == -1:
+                # Only a partly written line is left - treat it as EOF
+                return (offset, [])
+            end = breakpos + 1
+            # Split the chunk into (roughly equal) sub-ranges, on newline boundaries
+            bounds = [offset]
+            for i in range(1, processes):
+                breakpos = mm.find(b"\n", offset + (end - offset) * i // processes, end)
+                if breakpos != -1 and breakpos + 1 > bounds[-1]:
+                    bounds.append(breakpos + 1)
+            bounds.append(end)
+    starts, ends = bounds[:-1], bounds[1:]
+
+    if len(starts) > 1 and not multiprocessing.current_process().daemon:
+        with _parse_executor_lock:
+            if _parse_executor is None:
+                _parse_executor = ProcessPoolExecutor(
+                    processes, mp_context=multiprocessing.get_context("forkserver")
+                )
+        batches = _parse_executor.map(
+            _parse_csv_range, [filename] * len(starts), starts, ends
+        )
+    else:
+        batches = [_parse_csv_range(filename, offset, end)]
+    # Position of each wanted column in the rows
+    positions = [(name, fieldnames.index(name)) for name in columns or fieldnames]
+    return (
+        end,
+        [
+            {name: values[i] for name, i in positions if i < len(values)}
+            for batch in batches
+            for values in batch
+        ],
+    )
+
+
+def dump_json_atomic(obj: Any, filename: str):
     """
-    Return the new breakpos to continue reading from, and the read content
-    Trim off everything after the last `delimiter` from content (that should be part of
-    the next read) and decode it to utf-8
+    Store `obj` as json into given filename, atomically
+
+    The json is written to a temporary file, flushed to disk, and then renamed over
+    the given filename - so readers (and crashes) either see the old file in full
+    or the new file in full, never a partially written one
     """
-    return (breakpos, content[: -i or content_len].decode("utf-8"))
+    tmpname = f"{filename}.{os.getpid()}.tmp"
+    with open(tmpname, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname, filename)
+    # Make the rename itself durable
+    dirfd = os.open(os.path.dirname(filename) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
 
 
 def chunks_of(ls: List[Any], n: int):
@@ -0,0 +1,23 @@
+"""
+Entry point of the web process - `FLASK_APP=app.web flask run`
+
+Loads the web views (and the CLI commands) on top of the core app
+The task modules are never loaded - views refer to the tasks by name only
+(see `app.operations.task_signature`)
+"""
+from flask.templating import render_template
+
+from app import app
+
+
+@app.route("/")
+def index():
+    return render_template("base.html")
+
+
+from app import recovery
+
+recovery.init_app(app)
+
+from app import auth
+from app import operations
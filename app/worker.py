@@ -0,0 +1,9 @@
+"""
+Entry point of the worker processes - `celery -A app.worker worker`
+
+Registers the task modules on top of the core app, none of the web views are loaded
+The task modules are imported by the worker itself, once it has started up
+"""
+from app import celery
+
+celery.conf.include = ["app.tasks"]
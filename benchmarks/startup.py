@@ -0,0 +1,155 @@
+"""
+Startup time benchmark of the web and worker entry points
+
+Measures
+- The import time of each entry point, in a fresh interpreter for each run
+- The time a fresh worker takes to consume its first task - from spawning the worker
+  process to the task succeeding. This needs a running broker (see `CELERY_BROKER_URL`)
+
+Run from the root of the repository -
+    python benchmarks/startup.py --runs 5 --first-task
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from queue import Empty, Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points to measure the import time of
+ENTRY_POINTS = ["app", "app.worker", "app.web"]
+
+# Imports an entry point, prints the time it took and the amount of loaded modules
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, len(sys.modules))
+"""
+
+
+def import_time(module: str, runs: int):
+    # Median import time of a module (in seconds), and the amount of loaded modules
+    times, modules = [], 0
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        elapsed, modules = out.split()
+        times.append(float(elapsed))
+    return statistics.median(times), int(modules)
+
+
+def forward_lines(stream, lines: Queue):
+    # Put each line of given stream into given queue, and `None` once it's closed
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def first_task_time(entry: str, timeout: float):
+    """
+    Time from spawning a worker through given entry point, to that worker having
+    consumed a task
+
+    The task is sent to a queue of its own, which only the spawned worker consumes
+    """
+    sys.path.insert(0, ROOT)
+    from app import celery
+
+    queue = f"startup-benchmark-{uuid.uuid4().hex}"
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "celery",
+            "-A",
+            entry,
+            "worker",
+            "--pool",
+            "solo",
+            "-l",
+            "info",
+            "-Q",
+            queue,
+            "-n",
+            f"{queue}@%h",
+        ],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    try:
+        celery.send_task(
+            "app.tasks.count_ratio",
+            args=(
+                {"Startup": {"Male": 0, "Female": 0}},
+                [{"company": "Startup", "gender": "Male"}],
+            ),
+            queue=queue,
+        )
+        # The worker logs each task it has finished - its output is read on a thread of
+        # its own, so the timeout holds even while the worker prints nothing
+        lines = Queue()
+        threading.Thread(
+            target=forward_lines, args=(worker.stdout, lines), daemon=True
+        ).start()
+        while True:
+            remaining = timeout - (time.perf_counter() - start)
+            try:
+                line = lines.get(timeout=max(remaining, 0))
+            except Empty:
+                raise RuntimeError(f"Worker didn't consume the task in {timeout}s")
+            if line is None:
+                raise RuntimeError("Worker exited before consuming the task")
+            if "succeeded" in line:
+                return time.perf_counter() - start
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5, help="Runs per measurement")
+    parser.add_argument(
+        "--first-task",
+        action="store_true",
+        help="Also measure the time to first task consumed (needs a broker)",
+    )
+    parser.add_argument(
+        "--worker-entry",
+        default="app.worker",
+        help="Entry point to spawn the worker through",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Seconds to wait for the first task"
+    )
+    args = parser.parse_args()
+
+    print("Import time (median)")
+    for module in ENTRY_POINTS:
+        elapsed, modules = import_time(module, args.runs)
+        print(f"  {module:<12}{elapsed * 1000:8.1f} ms{modules:6} modules")
+
+    if args.first_task:
+        times = [
+            first_task_time(args.worker_entry, args.timeout) for _ in range(args.runs)
+        ]
+        print(f"Time to first task consumed (median) - {args.worker_entry}")
+        print(f"  {statistics.median(times) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()